@@ -6,20 +6,35 @@
 # https://www.jensd.be
 # https://github.com/jensdepuydt
 
+import atexit
+import calendar
 import csv
 import http.server
-import os.path
+import json
+import os
 import re
 import threading
-from datetime import datetime
+import time
+import traceback
 
-import crcmod.predefined
 import serial
 
+try:
+    from fastcrc import crc16
+except ImportError:
+    crc16 = None
+
 
 # The folder shared by the webserver.
 DATA_FOLDER = "data"
 
+# The port the webserver listens on.
+HTTP_PORT = 8080
+
+# How long after the last CSV download we keep writing every telegram
+# to the CSVs. With only ?live consumers, one row per minute suffices.
+CSV_TTL = 300
+
 # Change your serial port here:
 SERIALPORT = '/dev/ttyUSB0'
 
@@ -27,9 +42,46 @@ SERIALPORT = '/dev/ttyUSB0'
 debug = False
 #debug = True
 
-DATA_LOCK = threading.Lock()
+# Published by main, read by the webserver. Rebinding a module-level
+# name to an immutable string is atomic under the GIL, so no lock is
+# needed around it.
 LATEST_DATA = ""
 
+# When a CSV was last downloaded; updated by the webserver.
+LAST_FILE_REQUEST = 0.0
+
+def _make_crc16_table():
+    # 256-entry lookup table for CRC-16/ARC (poly 0xA001 reflected),
+    # one table lookup + XOR per byte instead of 8 shift iterations.
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def _crc16_arc(data):
+    crc = 0x0000
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+# DSMR uses CRC-16/ARC (poly 0xA001 reflected, init 0x0000).
+# fastcrc runs the loop in native code; fall back to the table-driven
+# Python version where fastcrc has no wheel (e.g. an old DiskStation).
+_CRC16 = crc16.arc if crc16 else _crc16_arc
+
+# Matches one OBIS line: code, first (value) and optional second
+# (value) (gas lines carry (timestamp)(value)). With re.M this scans
+# the whole telegram in a single pass.
+_LINE_RE = re.compile(rb'^([0-9.:\-]+)\(([^)]*)\)(?:\(([^)]*)\))?', re.M)
+
 # Add/update OBIS codes here:
 obiscodes = {
     "0-0:1.0.0": "Timestamp",
@@ -60,33 +112,81 @@ obiscodes = {
     "0-1:24.2.1": "Gas consumption"
     }
 
+# bytes-keyed view of obiscodes so lookups run on the raw serial
+# bytes without decoding every line.
+_OBIS_BYTES = {code.encode('ascii'): desc for code, desc in obiscodes.items()}
+
+# Canonical CSV column order, derived once from the OBIS table
+# (dict.fromkeys drops the duplicate gas description).
+CSV_COLUMNS = list(dict.fromkeys(obiscodes.values()))
+
+# Rows buffered per CSV file before they are written out in one go.
+# At one telegram per second this bounds data loss to half a minute.
+CSV_BATCH_ROWS = 30
+
+# Pre-sized output dict copied per telegram instead of growing a fresh
+# one key by key; the key set is fixed anyway.
+_OUTPUT_TEMPLATE = dict.fromkeys(obiscodes.values())
+
 
+class CsvAppender:
+    # Keeps the CSV files open for the lifetime of the process instead
+    # of stat/open/write/close per row, and rotates them on day rollover.
+    def __init__(self):
+        self._date = None
+        self._files = {}
+        self._pending = {}
 
-def write_csv(filename, row_data):
-    file_exists = os.path.isfile(filename)
-    with open (filename, 'a') as csvfile:
-        headers = list(row_data.keys())
-        #['TimeStamp', 'light', 'Proximity']
-        writer = csv.DictWriter(csvfile, delimiter=',', lineterminator='\n',fieldnames=headers)
+    def writerow(self, filename, date, header, row):
+        if date != self._date:
+            # day rollover: flush and close the previous day's files
+            self.close()
+            self._date = date
+        entry = self._files.get(filename)
+        if entry is None:
+            csvfile = open(filename, 'a', buffering=1 << 16)
+            writer = csv.writer(csvfile, delimiter=',', lineterminator='\n')
+            if os.fstat(csvfile.fileno()).st_size == 0:
+                writer.writerow(header)  # file doesn't exist yet, write a header
+            entry = (csvfile, writer)
+            self._files[filename] = entry
+        pending = self._pending.setdefault(filename, [])
+        pending.append(row)
+        if len(pending) >= CSV_BATCH_ROWS:
+            self._flush(filename)
 
-        if not file_exists:
-            writer.writeheader()  # file doesn't exist yet, write a header
+    def _flush(self, filename):
+        pending = self._pending.get(filename)
+        if pending:
+            csvfile, writer = self._files[filename]
+            writer.writerows(pending)
+            # push the batch past the 64KB file buffer so the on-disk
+            # CSV (served over HTTP) never lags more than one batch
+            csvfile.flush()
+            pending.clear()
 
-        writer.writerow(row_data)
+    def close(self):
+        for filename, (csvfile, _) in self._files.items():
+            self._flush(filename)
+            csvfile.close()
+        self._files.clear()
+        self._pending.clear()
 
 
 def checkcrc(p1telegram):
     # check CRC16 checksum of telegram and return False if not matching
     # split telegram in contents and CRC16 checksum (format:contents!crc)
-    for match in re.compile(b'\r\n(?=!)').finditer(p1telegram):
-        p1contents = p1telegram[:match.end() + 1]
-        # CRC is in hex, so we need to make sure the format is correct
-        givencrc = hex(int(p1telegram[match.end() + 1:].decode('ascii').strip(), 16))
+    idx = p1telegram.rfind(b'\r\n!')
+    if idx < 0:
+        return False
+    p1contents = p1telegram[:idx + 3]
+    # CRC is in hex, parse it as an integer
+    givencrc = int(p1telegram[idx + 3:].strip(), 16)
     # calculate checksum of the contents
-    calccrc = hex(crcmod.predefined.mkPredefinedCrcFun('crc16')(p1contents))
+    calccrc = _CRC16(p1contents)
     # check if given and calculated match
     if debug:
-        print(f"Given checksum: {givencrc}, Calculated checksum: {calccrc}")
+        print(f"Given checksum: {givencrc:#x}, Calculated checksum: {calccrc:#x}")
     if givencrc != calccrc:
         if debug:
             print("Checksum incorrect, skipping...")
@@ -94,41 +194,88 @@ def checkcrc(p1telegram):
     return True
 
 
-def parsetelegramline(p1line):
-    # parse a single line of the telegram and try to get relevant data from it
-    unit = ""
-    if debug:
-        print(f"Parsing:{p1line}")
-    # get OBIS code from line (format:OBIS(value)
-    obis = p1line.split("(")[0]
-    if debug:
-        print(f"OBIS:{obis}")
-    # check if OBIS code is something we know and parse it
-    if obis in obiscodes:
-        # get values from line.
-        # format:OBIS(value), gas: OBIS(timestamp)(value)
-        values = re.findall(r'\(.*?\)', p1line)
-        value = values[0][1:-1]
-        # report of connected gas-meter...
-        if len(values) > 1:
-            value = values[1][1:-1]
+class P1RequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the CSV files from DATA_FOLDER, plus the latest telegram
+    # as JSON on /?live.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=DATA_FOLDER, **kwargs)
+
+    def do_GET(self):
+        global LAST_FILE_REQUEST
+        if self.path == '/?live':
+            if not LATEST_DATA:
+                # no telegram parsed yet; an empty body isn't valid JSON
+                self.send_error(503, "No telegram received yet")
+                return
+            data = LATEST_DATA.encode('ascii')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        LAST_FILE_REQUEST = time.time()
+        super().do_GET()
+
+
+def format_fixed(value):
+    # render the integer-thousandths meter totals back as fixed-point
+    # for the CSV; other values pass through unchanged
+    if isinstance(value, int):
+        return f"{value // 1000}.{value % 1000:03d}"
+    return value
+
+
+def to_unixtime(timestamp):
+    # convert a DSMR timestamp (YYMMDDhhmmssX, X=W/S for winter/summer
+    # time) to Unix time; the fields are fixed-position digits, so
+    # slicing + int() beats a general-purpose strptime by far
+    offset = 3600 if timestamp[12] == 'W' else 7200
+    return calendar.timegm((2000 + int(timestamp[0:2]), int(timestamp[2:4]),
+                            int(timestamp[4:6]), int(timestamp[6:8]),
+                            int(timestamp[8:10]), int(timestamp[10:12]),
+                            0, 0, 0)) - offset
+
+
+def parsetelegram(p1telegram):
+    # scan all OBIS lines of the telegram in one regex pass and return
+    # a dict of description:value for the codes we know
+    output = _OUTPUT_TEMPLATE.copy()
+    for match in _LINE_RE.finditer(p1telegram):
+        obis = match.group(1)
+        # check if OBIS code is something we know and parse it
+        desc = _OBIS_BYTES.get(obis)
+        if desc is None:
+            continue
+        unit = ""
+        # gas lines have a second (value); plain lines only the first
+        raw = match.group(3) or match.group(2)
         # serial numbers need different parsing: (hex to ascii)
-        if "96.1.1" in obis:
-            value = bytearray.fromhex(value).decode()
-        elif not"1.0.0" in obis:
+        if b'96.1.1' in obis:
+            value = bytearray.fromhex(raw.decode('ascii')).decode()
+        elif not b'1.0.0' in obis:
             # Timestamp cannot be parsed as a float.
-            # Other lines: separate value and unit (format:value*unit)
-            lvalue = value.split("*")
-            value = float(lvalue[0])
-            if len(lvalue) > 1:
-                unit = lvalue[1]
-        # return result in a dict: description,value,unit
+            # Other lines have the fixed format value*unit; float()
+            # accepts bytes, so slice at the '*' instead of split+decode
+            star = raw.find(b'*')
+            if star < 0:
+                value = float(raw)
+            else:
+                unit = raw[star + 1:].decode('ascii')
+                if unit in ('kWh', 'm3'):
+                    # meter totals are fixed-point with 3 decimals; keep
+                    # them as integer thousandths so sums stay exact
+                    value = int(raw[:star].replace(b'.', b''))
+                else:
+                    value = float(raw[:star])
+        else:
+            value = raw.decode('ascii')
         if debug:
-            print (f"description:{obiscodes[obis]}, \
+            print (f"description:{desc}, \
                      value:{value}, \
                      unit:{unit}")
-        return { "desc": obiscodes[obis], "value": value, "unit": unit }
-    return {}
+        output[desc] = value
+    return output
 
 
 def main():
@@ -141,64 +288,75 @@ def main():
 
     global LATEST_DATA
 
-    p1telegram = bytearray()
+    csv_appender = CsvAppender()
+    # make sure buffered rows reach disk on any exit path
+    atexit.register(csv_appender.close)
+
+    # Start the webserver next to the reader loop. A single-threaded
+    # HTTPServer is enough: there is one ?live endpoint plus small CSV
+    # downloads, each served in microseconds, and it avoids spawning a
+    # thread per request like ThreadingHTTPServer does.
+    httpd = http.server.HTTPServer(('', HTTP_PORT), P1RequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    last_minute = None
 
     while True:
         try:
-            # read input from serial port
-            p1line = ser.readline()
+            # P1 telegram starts with / and ends with ! + CRC16 checksum.
+            # Sync to the start marker, then read the telegram body and
+            # the CRC tail in whole chunks instead of line by line.
+            ser.read_until(b'/')
+            body = ser.read_until(b'!')
+            crc = ser.read(6)  # 4 hex digits + \r\n
+            p1telegram = b'/' + body + crc
             if debug:
-                print("Reading: ", p1line.strip())
-            # P1 telegram starts with /
-            # We need to create a new empty telegram
-            if "/" in p1line.decode('ascii'):
-                if debug:
-                    print("Found beginning of P1 telegram")
-                    print('*' * 60 + "\n")
-                p1telegram = bytearray()
-                # add line to complete telegram
-            p1telegram.extend(p1line)
-            # P1 telegram ends with ! + CRC16 checksum
-            if "!" in p1line.decode('ascii'):
-                if debug:
-                    print("Found end, printing full telegram")
-                    print('*' * 40)
-                    print(p1telegram.decode('ascii').strip())
-                    print('*' * 40)
-                if checkcrc(p1telegram):
-                    # parse telegram contents, line by line
-                    output = {}
-                    for line in p1telegram.split(b'\r\n'):
-                        row = parsetelegramline(line.decode('ascii'))
-                        if row:
-                            output[row["desc"]]=row["value"]
-                            if debug:
-                                print(f"desc:{row['desc']}, val:{row['value']}, u:{row['unit']}")
-#                    print(output)
-#                    print(tabulate(output,
-#                                   headers=['Description', 'Value', 'Unit'],
-#                                   tablefmt='github'))
-                    date = output['Timestamp'][0:6]
-                    write_csv(f"data/{date}.csv", output)
-
-
-                    json = f"{{\"ts\":\"{timestamp}\",\"c\":\"{consumption}\",\"p\":\"{production}\"}}"
-                    with DATA_LOCK:
-                        LATEST_DATA = json
-#                    minute = output['Timestamp'][0:10]
-#                    writeCsv(f"{minute}.csv", output)
+                print("Read full telegram")
+                print('*' * 40)
+                print(p1telegram.decode('ascii').strip())
+                print('*' * 40)
+            if checkcrc(p1telegram):
+                # parse telegram contents in one pass
+                output = parsetelegram(p1telegram)
+                if output['Timestamp'] is None:
+                    continue
+#                print(output)
+#                print(tabulate(output,
+#                               headers=['Description', 'Value', 'Unit'],
+#                               tablefmt='github'))
+                # Write every telegram to the CSVs only while someone
+                # recently downloaded them; with only ?live consumers,
+                # downsample to one row per minute.
+                date = output['Timestamp'][0:6]
+                minute = output['Timestamp'][0:10]
+                if (minute != last_minute
+                        or time.time() - LAST_FILE_REQUEST < CSV_TTL):
+                    row = tuple(format_fixed(output.get(column, ""))
+                                for column in CSV_COLUMNS)
+                    csv_appender.writerow(f"data/{date}.csv", date, CSV_COLUMNS, row)
+                    last_minute = minute
+
+
+                # the totals are integer thousandths, so the sums are
+                # exact; scale back to kWh only for publishing
+                consumption = (output['Rate 1 (day) - total consumption']
+                               + output['Rate 2 (night) - total consumption'])
+                production = (output['Rate 1 (day) - total production']
+                              + output['Rate 2 (night) - total production'])
+                LATEST_DATA = json.dumps({"ts": to_unixtime(output['Timestamp']),
+                                          "c": consumption / 1000,
+                                          "p": production / 1000})
+#                minute = output['Timestamp'][0:10]
+#                writeCsv(f"{minute}.csv", output)
         except KeyboardInterrupt:
             print("Stopping...")
+            csv_appender.close()
             ser.close()
             break
-        except:
+        except (serial.SerialException, UnicodeDecodeError, ValueError, KeyError) as e:
             if debug:
                 print(traceback.format_exc())
-            # print(traceback.format_exc())
-            print ("Something went wrong...")
-            ser.close()
-        # flush the buffer
-        ser.flush()
+            print(f"Something went wrong: {e!r}")
 
 
 if __name__ == '__main__':